@@ -79,7 +79,7 @@ def compute_knn_by_features(
 
     3. If ``similarity_log_data`` (default: {similarity_log_data}), invoke the
        :py:func:`metacells.utilities.computation.log_data` function to compute the log (base 2) of
-       the data.
+       the data (adding a positive normalization as part of computing the log).
 
     4. Invoke :py:func:`metacells.tools.similarity.compute_obs_obs_similarity` using
        ``similarity_method`` (default: {similarity_method}), ``logistics_location`` (default:
@@ -95,19 +95,33 @@ def compute_knn_by_features(
     tl.find_top_feature_genes(adata, max_genes=max_top_feature_genes)
 
     all_data = ut.get_vo_proper(adata, what, layout='row_major')
-    all_fractions = ut.fraction_by(all_data, by='row')
+    total_umis_of_cells = ut.sum_per(all_data, per='row')
 
     top_feature_genes_mask = ut.get_v_numpy(adata, 'top_feature_gene')
 
-    top_feature_genes_fractions = all_fractions[:, top_feature_genes_mask]
+    # Only compute the fractions of the top feature genes (out of the total of all the genes), while
+    # keeping the data in row-major layout, to avoid re-layout of the result.
+    top_feature_genes_indices = np.flatnonzero(top_feature_genes_mask)
+    all_dense = ut.maybe_numpy_matrix(all_data)
+    if all_dense is not None:
+        # Unlike ``[:, indices]``, ``np.take`` returns a row-major matrix.
+        top_feature_genes_data = np.take(all_dense, top_feature_genes_indices, axis=1)
+    else:
+        top_feature_genes_data = all_data[:, top_feature_genes_indices]
     top_feature_genes_fractions = \
-        ut.to_layout(top_feature_genes_fractions, layout='row_major')
+        ut.fraction_by(top_feature_genes_data, sums=total_umis_of_cells, by='row')
 
-    top_feature_genes_fractions += similarity_value_normalization
-
-    if similarity_log_data:
+    # The log_data function treats a non-positive normalization specially, so only let it add a
+    # positive normalization.
+    if similarity_log_data and similarity_value_normalization > 0:
         top_feature_genes_fractions = \
-            ut.log_data(top_feature_genes_fractions, base=2)
+            ut.log_data(top_feature_genes_fractions, base=2,
+                        normalization=similarity_value_normalization)
+    else:
+        top_feature_genes_fractions += similarity_value_normalization
+        if similarity_log_data:
+            top_feature_genes_fractions = \
+                ut.log_data(top_feature_genes_fractions, base=2)
 
     tdata = ut.slice(adata, vars=top_feature_genes_mask)
     similarities = tl.compute_obs_obs_similarity(tdata,
@@ -187,7 +201,9 @@ def compute_umap_by_features(
 
     2. Invoke :py:func:`metacells.tools.layout.umap_by_distances` using the distances, ``umap_k``
        (default: {umap_k}), ``min_dist`` (default: {min_dist}), ``spread`` (default: {spread}),
-       dimensions (default: {dimensions})q    '''
+       dimensions (default: {dimensions}). The distances are only given for the ``umap_k`` most
+       similar metacells of each metacell, as this is all UMAP uses anyway.
+    '''
     similarities = compute_knn_by_features(adata, what,
                                            max_top_feature_genes=max_top_feature_genes,
                                            similarity_value_normalization=similarity_value_normalization,
@@ -201,17 +217,39 @@ def compute_umap_by_features(
                                            outgoing_degree_factor=outgoing_degree_factor,
                                            reproducible=(random_seed != 0))
 
-    distances = ut.to_numpy_matrix(similarities)
-    distances *= -1
-    distances += 1
-    np.fill_diagonal(distances, 0.0)
-    distances = sparse.csr_matrix(distances)
+    distances = _knn_distances(ut.to_numpy_matrix(similarities), umap_k)
 
     tl.umap_by_distances(adata, distances, k=umap_k, dimensions=dimensions,
                          min_dist=min_dist, spread=spread,
                          random_seed=random_seed)
 
 
+@ut.timed_call()
+def _knn_distances(similarities: ut.NumpyMatrix, k: int) -> ut.CompressedMatrix:
+    size = similarities.shape[0]
+
+    # Also pick each metacell itself (which we drop below), to ensure each one has at least ``k``
+    # neighbors (possibly one more if there are ties).
+    neighbors_count = min(k + 1, size)
+    partition_index = size - neighbors_count
+    neighbor_indices = \
+        np.argpartition(similarities, partition_index, axis=1)[:, partition_index:]
+
+    rows = np.repeat(np.arange(size), neighbors_count)
+    columns = neighbor_indices.ravel()
+    not_self_mask = rows != columns
+    rows = rows[not_self_mask]
+    columns = columns[not_self_mask]
+
+    # UMAP requires the (sparse) distances to be symmetrical, so we keep the union of the edges.
+    edge_keys = np.unique(np.concatenate([rows * size + columns, columns * size + rows]))
+    rows, columns = np.divmod(edge_keys, size)
+
+    # Zero distances are kept as explicit entries, since UMAP treats structural zeros as real edges.
+    distances = 1 - similarities[rows, columns]
+    return sparse.csr_matrix((distances, (rows, columns)), shape=(size, size))
+
+
 def _build_igraph(edge_weights: ut.Matrix) -> Tuple[ig.Graph, ut.NumpyVector]:
     edge_weights = ut.to_proper_matrix(edge_weights)
     assert edge_weights.shape[0] == edge_weights.shape[1]
@@ -180,7 +180,7 @@ def _collect_fold_factors(  # pylint: disable=too-many-statements
 
     for candidate_index in range(candidates_count):
         candidate_cell_indices = \
-            np.where(candidate_of_cells == candidate_index)[0]
+            np.flatnonzero(candidate_of_cells == candidate_index)
 
         candidate_cells_count = candidate_cell_indices.size
         assert candidate_cells_count > 0
@@ -256,7 +256,7 @@ def _collect_fold_factors(  # pylint: disable=too-many-statements
 
     if remaining_cells_count > 0:
         assert remaining_cells_count == np.sum(candidate_of_cells < 0)
-        list_of_cell_index_of_rows.append(np.where(candidate_of_cells < 0)[0])
+        list_of_cell_index_of_rows.append(np.flatnonzero(candidate_of_cells < 0))
         compressed = \
             sparse.csr_matrix(([], [], [0] * (remaining_cells_count + 1)),
                               shape=(remaining_cells_count, genes_count))
@@ -326,7 +326,7 @@ def _filter_genes(
     if ut.logging_calc():
         ut.log_calc('deviant_genes', mask_of_deviant_genes)
 
-    deviant_gene_indices = np.where(mask_of_deviant_genes)[0]
+    deviant_gene_indices = np.flatnonzero(mask_of_deviant_genes)
     return deviant_gene_indices
 
 
@@ -120,7 +120,7 @@ def dissolve_metacells(
     did_dissolve = False
     for candidate_index in range(candidates_count):
         candidate_cell_indices = \
-            np.where(candidate_of_cells == candidate_index)[0]
+            np.flatnonzero(candidate_of_cells == candidate_index)
         if not _keep_candidate(adata, candidate_index,
                                data=data,
                                cell_sizes=cell_sizes,
@@ -226,7 +226,7 @@ def _keep_candidate(  # pylint: disable=too-many-branches
     keep_candidate = bool(np.any(convincing_genes_mask))
 
     if ut.logging_calc():
-        convincing_gene_indices = np.where(convincing_genes_mask)[0]
+        convincing_gene_indices = np.flatnonzero(convincing_genes_mask)
         if keep_candidate:
             ut.log_calc(f'- candidate: {ut.progress_description(candidates_count, candidate_index, "candidate")} '
                         f'cells: {candidate_cell_indices.size} '
@@ -66,13 +66,15 @@ def find_top_feature_genes(
         ut.get_v_numpy(adata, 'feature_gene', formatter=ut.mask_description)
     max_threshold = np.max(feature_of_gene)
     assert max_threshold > 0
-    threshold = 0
-    selected_count = max_genes + 1
-    while selected_count > max_genes and threshold < max_threshold:
-        threshold = threshold + 1
-        genes_mask = feature_of_gene >= threshold
-        selected_count = np.sum(genes_mask)
-        ut.log_calc(f'threshold: {threshold} selected: {selected_count}')
+    threshold = 1
+    if feature_of_gene.size > max_genes:
+        # At most ``max_genes`` are selected iff the threshold is above the next highest value.
+        partition_index = feature_of_gene.size - max_genes - 1
+        next_value = np.partition(feature_of_gene, partition_index)[partition_index]
+        threshold = max(threshold, int(np.floor(next_value)) + 1)
+    threshold = min(threshold, int(np.ceil(max_threshold)))
+    genes_mask = feature_of_gene >= threshold
+    ut.log_calc(f'threshold: {threshold} selected: {np.sum(genes_mask)}')
 
     if inplace:
         ut.set_v_data(adata, 'top_feature_gene', genes_mask)
@@ -86,17 +86,30 @@ def umap_by_distances(
                                 min_dist=min_dist,
                                 n_components=dimensions,
                                 random_state=random_state).fit_transform(distances_csr)
-    except ValueError:
+    except ValueError as error:
         # UMAP implementation doesn't know how to handle too few edges.
-        # However, it considers structural zeros as real edges.
-        distances_matrix = distances_matrix + 1.0  # type: ignore
-        np.fill_diagonal(distances_matrix, 0.0)
-        distances_csr = sp.csr_matrix(distances_matrix)
-        distances_csr.data -= 1.0
+        # However, it considers structural zeros as real edges, so we directly construct a CSR
+        # matrix containing all the off-diagonal entries, including the zero ones.
+        if ut.maybe_compressed_matrix(distances_matrix) is not None:
+            # For sparse distances, the missing entries are not edges, so there are no more edges
+            # to add, and retrying would just fail in the same way.
+            raise ValueError('UMAP failed for the sparse distances of: %s (too few edges?): %s'
+                             % (ut.get_name(adata), error)) from error
+
+        distances_dense = ut.to_numpy_matrix(distances_matrix)
+        size = distances_dense.shape[0]
+        off_diagonal_mask = ~np.eye(size, dtype='bool')
+        distances_csr = \
+            sp.csr_matrix((distances_dense[off_diagonal_mask],
+                           np.broadcast_to(np.arange(size, dtype='int32'),
+                                           (size, size))[off_diagonal_mask],
+                           np.arange(size + 1) * (size - 1)),
+                          shape=(size, size))
         coordinates = umap.UMAP(metric='precomputed',
                                 n_neighbors=n_neighbors,
                                 spread=spread,
                                 min_dist=min_dist,
+                                n_components=dimensions,
                                 random_state=random_state).fit_transform(distances_csr)
 
     all_sizes = []
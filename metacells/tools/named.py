@@ -43,8 +43,7 @@ def find_named_genes(
     if names is None:
         names_mask = np.zeros(adata.n_vars, dtype='bool')
     else:
-        names_set = set(names)
-        names_mask = np.array([name in names_set for name in adata.var_names])
+        names_mask = adata.var_names.isin(set(names))
 
     if patterns is None:
         patterns_mask = np.zeros(adata.n_vars, dtype='bool')
@@ -169,11 +169,11 @@ def project_obs_obs_to_group_group(
 
     # TODO: This is a slow implementation.
     for row_group in range(gdata.n_obs):
-        row_cells = np.where(group_of_obs == row_group)[0]
+        row_cells = np.flatnonzero(group_of_obs == row_group)
         assert len(row_cells) > 0
 
         for column_group in range(gdata.n_obs):
-            column_cells = np.where(group_of_obs == column_group)[0]
+            column_cells = np.flatnonzero(group_of_obs == column_group)
             assert len(column_cells) > 0
 
             property_of_group_group[row_group, column_group] = \
@@ -71,12 +71,15 @@ def find_properly_sampled_cells(
     total_of_cells = ut.get_o_numpy(adata, what, sum=True)
 
     cells_mask = np.full(adata.n_obs, True, dtype='bool')
+    compared_mask = np.empty(adata.n_obs, dtype='bool')
 
     if min_cell_total is not None:
-        cells_mask = cells_mask & (total_of_cells >= min_cell_total)
+        np.greater_equal(total_of_cells, min_cell_total, out=compared_mask)
+        cells_mask &= compared_mask
 
     if max_cell_total is not None:
-        cells_mask = cells_mask & (total_of_cells <= max_cell_total)
+        np.less_equal(total_of_cells, max_cell_total, out=compared_mask)
+        cells_mask &= compared_mask
 
     if excluded_adata is not None:
         assert max_excluded_genes_fraction is not None
@@ -86,8 +89,8 @@ def find_properly_sampled_cells(
             total_of_cells = np.copy(total_of_cells)
             total_of_cells[total_of_cells == 0] = 1
         excluded_fraction = excluded_of_cells / total_of_cells
-        cells_mask = \
-            cells_mask & (excluded_fraction <= max_excluded_genes_fraction)
+        np.less_equal(excluded_fraction, max_excluded_genes_fraction, out=compared_mask)
+        cells_mask &= compared_mask
 
     if inplace:
         ut.set_o_data(adata, 'properly_sampled_cell', cells_mask)
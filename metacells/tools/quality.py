@@ -309,7 +309,7 @@ def _collect_group_data(
     variance_per_gene_per_group: ut.NumpyMatrix,
     normalized_variance_per_gene_per_group: ut.NumpyMatrix,
 ) -> None:
-    cell_indices = np.where(group_of_cells == group_index)[0]
+    cell_indices = np.flatnonzero(group_of_cells == group_index)
     cells_count = len(cell_indices)
     if cells_count < 2:
         return
@@ -4,7 +4,7 @@ Rare
 '''
 
 from re import Pattern
-from typing import Collection, List, Optional, Set, Tuple, Union
+from typing import Collection, Dict, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import scipy.cluster.hierarchy as sch  # type: ignore
@@ -21,6 +21,11 @@ __all__ = [
     'find_rare_gene_modules',
 ]
 
+# The hierarchical clustering methods for which SciPy uses an ``O(N^2)`` algorithm (minimum
+# spanning tree for ``single``, nearest-neighbor-chain for the rest), as opposed to the generic
+# ``O(N^3)`` algorithm it uses for ``centroid`` and ``median``.
+_FAST_CLUSTER_METHODS = ('single', 'complete', 'average', 'weighted', 'ward')
+
 
 @ut.logged()
 @ut.timed_call()
@@ -100,7 +105,8 @@ def find_rare_gene_modules(
        ``genes_similarity_method`` (default: {genes_similarity_method}).
 
     3. Create a hierarchical clustering of the candidate genes using the ``genes_cluster_method``
-       (default: {genes_cluster_method}).
+       (default: {genes_cluster_method}). This must be one of the methods for which SciPy uses an
+       ``O(N^2)`` algorithm (``single``, ``complete``, ``average``, ``weighted`` or ``ward``).
 
     4. Identify gene modules in the hierarchical clustering which contain at least
        ``min_genes_of_modules`` genes (default: {min_genes_of_modules}), with an average gene-gene
@@ -135,6 +141,7 @@ def find_rare_gene_modules(
     '''
     assert min_cells_of_modules > 0
     assert min_genes_of_modules > 0
+    assert genes_cluster_method in _FAST_CLUSTER_METHODS
 
     forbidden_genes_mask = \
         find_named_genes(adata, names=forbidden_gene_names,
@@ -237,14 +244,18 @@ def _pick_candidates(
     nnz_cell_fraction_mask_of_genes = \
         nnz_cell_fraction_of_genes <= max_gene_cell_fraction
 
-    max_umis_of_genes = ut.max_per(data, per='column')
-    max_umis_mask_of_genes = max_umis_of_genes >= min_gene_maximum
-
-    candidates_mask_of_genes = \
-        max_umis_mask_of_genes & nnz_cell_fraction_mask_of_genes & allowed_genes_mask
+    # Only compute the maximal UMIs of the genes which pass the cheap filters. These are rare genes,
+    # so this avoids scanning the bulk of the data (which belongs to the common genes).
+    candidates_mask_of_genes = nnz_cell_fraction_mask_of_genes & allowed_genes_mask
+    filtered_genes_indices = np.flatnonzero(candidates_mask_of_genes)
+    if filtered_genes_indices.size > 0:
+        max_umis_of_filtered_genes = \
+            ut.max_per(data[:, filtered_genes_indices], per='column')
+        candidates_mask_of_genes[filtered_genes_indices] = \
+            max_umis_of_filtered_genes >= min_gene_maximum
     ut.log_calc('candidate_genes', candidates_mask_of_genes)
 
-    candidate_genes_indices = np.where(candidates_mask_of_genes)[0]
+    candidate_genes_indices = np.flatnonzero(candidates_mask_of_genes)
     candidate_genes_count = candidate_genes_indices.size
     if candidate_genes_count < min_genes_of_modules:
         return None
@@ -276,15 +287,27 @@ def _genes_similarity(
 def _cluster_genes(
     similarities_between_candidate_genes: ut.NumpyMatrix,
     genes_cluster_method: str,
-) -> List[Tuple[int, int]]:
-    with ut.timed_step('scipy.pdist'):
+) -> ut.NumpyMatrix:
+    with ut.timed_step('.distances'):
         ut.timed_parameters(size=similarities_between_candidate_genes.shape[0])
-        distances = scd.pdist(similarities_between_candidate_genes)
+        # Same as ``scd.pdist(..., metric='euclidean')``, but using a single (BLAS) matrix
+        # multiplication instead of a scalar loop over all pairs. This is done in double precision
+        # (like ``pdist`` does anyway) to avoid cancellation errors for similar genes.
+        similarities = similarities_between_candidate_genes.astype('float64', copy=False)
+        squared_norms = np.einsum('ij,ij->i', similarities, similarities)
+        squared_distances = similarities @ similarities.T
+        squared_distances *= -2
+        squared_distances += squared_norms[:, None]
+        squared_distances += squared_norms[None, :]
+        np.maximum(squared_distances, 0, out=squared_distances)
+        np.fill_diagonal(squared_distances, 0)
+        distances = scd.squareform(np.sqrt(squared_distances, out=squared_distances), checks=False)
 
     with ut.timed_step('scipy.linkage'):
         ut.timed_parameters(size=distances.shape[0],
                             method=genes_cluster_method)
-        linkage = sch.linkage(distances, method=genes_cluster_method)
+        linkage = sch.linkage(distances, method=genes_cluster_method,
+                              metric='euclidean')
 
     return linkage
 
@@ -295,44 +318,76 @@ def _identify_genes(
     candidate_genes_indices: ut.NumpyVector,
     similarities_between_candidate_genes: ut.NumpyMatrix,
     min_module_correlation: float,
-    linkage: List[Tuple[int, int]],
+    linkage: ut.NumpyMatrix,
 ) -> List[List[int]]:
     candidate_genes_count = candidate_genes_indices.size
-    np.fill_diagonal(similarities_between_candidate_genes, None)
-    combined_candidate_indices = \
-        {index: [index] for index in range(candidate_genes_count)}
-
-    for link_index, link_data in enumerate(linkage):
-        link_index += candidate_genes_count
-
-        left_index = int(link_data[0])
-        right_index = int(link_data[1])
-
-        left_combined_candidates = \
-            combined_candidate_indices.get(left_index)
-        right_combined_candidates = \
-            combined_candidate_indices.get(right_index)
-        if not left_combined_candidates or not right_combined_candidates:
-            continue
 
-        link_combined_candidates = \
-            sorted(left_combined_candidates + right_combined_candidates)
-        assert link_combined_candidates
-        link_similarities = \
-            similarities_between_candidate_genes[link_combined_candidates,  #
-                                                 :][:,
-                                                    link_combined_candidates]
-        average_link_similarity = np.nanmean(link_similarities)
-        if average_link_similarity < min_module_correlation:
-            continue
-
-        combined_candidate_indices[link_index] = link_combined_candidates
-        del combined_candidate_indices[left_index]
-        del combined_candidate_indices[right_index]
+    # The genes of each link are a contiguous range of the dendrogram leaves order, so the sum of
+    # the (off-diagonal) similarities inside each link is a block sum of a cumulative sums table.
+    leaves_order = sch.leaves_list(linkage)
+    leaves_position = np.empty(candidate_genes_count, dtype='int64')
+    leaves_position[leaves_order] = np.arange(candidate_genes_count)
 
-    return [candidate_genes_indices[candidate_indices]
-            for candidate_indices
-            in combined_candidate_indices.values()]
+    links_count = candidate_genes_count - 1
+    link_sizes = linkage[:, 3].astype('int64')
+    link_starts = np.empty(links_count, dtype='int64')
+    for link_index, link_data in enumerate(linkage):
+        link_starts[link_index] = min(_start_of(int(link_data[0]), leaves_position, link_starts),
+                                      _start_of(int(link_data[1]), leaves_position, link_starts))
+    link_stops = link_starts + link_sizes
+
+    # We only want the off-diagonal similarities, so we zero the diagonal of our reordered copy
+    # (instead of filling it with ``NaN`` and using ``nansum``/``nanmean``).
+    ordered_similarities = \
+        similarities_between_candidate_genes[np.ix_(leaves_order, leaves_order)]
+    np.fill_diagonal(ordered_similarities, 0.0)
+    cumulative_similarities = np.zeros((candidate_genes_count + 1, candidate_genes_count + 1))
+    np.cumsum(ordered_similarities, axis=0, out=cumulative_similarities[1:, 1:])
+    np.cumsum(cumulative_similarities[1:, 1:], axis=1, out=cumulative_similarities[1:, 1:])
+
+    total_link_similarities = \
+        cumulative_similarities[link_stops, link_stops] \
+        - cumulative_similarities[link_starts, link_stops] \
+        - cumulative_similarities[link_stops, link_starts] \
+        + cumulative_similarities[link_starts, link_starts]
+    average_link_similarities = \
+        total_link_similarities / (link_sizes * (link_sizes - 1))
+
+    # A link is a module if it, and all the links below it, have a high enough average similarity.
+    inconsistency = np.zeros((links_count, 4), dtype='float64')
+    inconsistency[:, 3] = -average_link_similarities
+    monocrit = sch.maxRstat(linkage, inconsistency, 3)
+    cluster_of_candidates = \
+        sch.fcluster(linkage, t=-min_module_correlation, criterion='monocrit', monocrit=monocrit)
+
+    # Order the modules as if we merged them while walking the linkage: first the unmerged genes,
+    # then the merged modules by the order of their top link.
+    top_link_of_clusters = np.full(np.max(cluster_of_candidates) + 1, -1, dtype='int64')
+    module_links_mask = monocrit <= -min_module_correlation
+    module_link_indices = np.flatnonzero(module_links_mask)
+    cluster_of_module_links = \
+        cluster_of_candidates[leaves_order[link_starts[module_links_mask]]]
+    np.maximum.at(top_link_of_clusters, cluster_of_module_links, module_link_indices)
+
+    candidate_indices_of_clusters: Dict[int, List[int]] = {}
+    for candidate_index, cluster_index in enumerate(cluster_of_candidates):
+        candidate_indices_of_clusters.setdefault(cluster_index, []).append(candidate_index)
+
+    return [candidate_genes_indices[candidate_indices_of_clusters[cluster_index]]
+            for cluster_index
+            in sorted(candidate_indices_of_clusters.keys(),
+                      key=lambda cluster_index: (top_link_of_clusters[cluster_index],
+                                                 candidate_indices_of_clusters[cluster_index][0]))]
+
+
+def _start_of(
+    index: int,
+    leaves_position: ut.NumpyVector,
+    link_starts: ut.NumpyVector,
+) -> int:
+    if index < leaves_position.size:
+        return leaves_position[index]
+    return link_starts[index - leaves_position.size]
 
 
 @ut.timed_call()
@@ -353,6 +408,10 @@ def _related_genes(  # pylint: disable=too-many-statements,too-many-branches
     total_all_cells_umis_of_all_genes = \
         ut.get_v_numpy(adata_of_all_genes_of_all_cells, what, sum=True)
 
+    # Column-major so we can efficiently access the data of each candidate related gene below.
+    data_of_all_genes_of_all_cells = \
+        ut.get_vo_proper(adata_of_all_genes_of_all_cells, what, layout='column_major')
+
     ut.log_calc('genes for modules:')
     modules_count = 0
     related_gene_indices_of_modules: List[List[int]] = []
@@ -436,15 +495,10 @@ def _related_genes(  # pylint: disable=too-many-statements,too-many-branches
                    >= background_cells_fraction_of_all_genes
                    * (2 ** min_related_gene_fold_factor))
 
-            related_gene_indices = np.where(mask_of_related_genes)[0]
+            related_gene_indices = np.flatnonzero(mask_of_related_genes)
             assert np.all(mask_of_related_genes[rare_gene_indices_of_module])
 
-            base_genes_of_all_cells_adata = \
-                ut.slice(adata_of_all_genes_of_all_cells,
-                         name=f'.module{module_index}.base',
-                         vars=rare_gene_indices_of_module)
-            total_base_genes_of_all_cells = \
-                ut.get_o_numpy(base_genes_of_all_cells_adata, what, sum=True)
+            total_base_genes_of_all_cells = total_module_genes_umis_of_all_cells
             mask_of_strong_base_cells = \
                 total_base_genes_of_all_cells >= min_cell_module_total
             count_of_strong_base_cells = np.sum(mask_of_strong_base_cells)
@@ -465,15 +519,9 @@ def _related_genes(  # pylint: disable=too-many-statements,too-many-branches
                     continue
 
                 if gene_index not in rare_gene_indices_of_module:
-                    related_gene_of_all_cells_adata = \
-                        ut.slice(adata_of_all_genes_of_all_cells,
-                                 name=f'.{adata_of_all_genes_of_all_cells.var_names[gene_index]}',
-                                 vars=np.array([gene_index]))
-                    assert related_gene_of_all_cells_adata.n_vars == 1
                     total_related_genes_of_all_cells = \
-                        ut.get_o_numpy(related_gene_of_all_cells_adata,
-                                       what, sum=True)
-                    total_related_genes_of_all_cells += total_base_genes_of_all_cells
+                        ut.to_numpy_vector(data_of_all_genes_of_all_cells[:, gene_index]) \
+                        + total_base_genes_of_all_cells
                     mask_of_strong_related_cells = \
                         total_related_genes_of_all_cells >= min_cell_module_total
                     count_of_strong_related_cells = \
@@ -510,10 +558,18 @@ def _identify_cells(
     max_cells_of_modules: int,
     rare_module_of_cells: ut.NumpyVector,
 ) -> None:
-    max_strength_of_cells = np.zeros(adata_of_all_genes_of_all_cells.n_obs)
+    total_related_genes_of_all_cells_of_modules = \
+        _sum_modules_of_cells(adata_of_all_genes_of_all_cells=adata_of_all_genes_of_all_cells,
+                              what=what,
+                              related_gene_indices_of_modules=related_gene_indices_of_modules)
+
+    mask_of_strong_cells_of_modules = \
+        total_related_genes_of_all_cells_of_modules >= min_cell_module_total
+    strong_cells_count_of_modules = np.sum(mask_of_strong_cells_of_modules, axis=0)
 
     ut.log_calc('cells for modules:')
     modules_count = len(related_gene_indices_of_modules)
+    mask_of_used_modules = np.zeros(modules_count, dtype='bool')
     for module_index, related_gene_indices_of_module \
             in enumerate(related_gene_indices_of_modules):
         if len(related_gene_indices_of_module) == 0:
@@ -523,28 +579,13 @@ def _identify_cells(
                          formatter=lambda module_index:
                          ut.progress_description(modules_count,
                                                  module_index, 'module')):
-            adata_of_related_genes_of_all_cells = \
-                ut.slice(adata_of_all_genes_of_all_cells,
-                         name=f'.module{module_index}.related_genes',
-                         vars=related_gene_indices_of_module,
-                         top_level=False)
-            total_related_genes_of_all_cells = \
-                ut.get_o_numpy(adata_of_related_genes_of_all_cells,
-                               what, sum=True)
-
-            mask_of_strong_cells_of_module = \
-                total_related_genes_of_all_cells >= min_cell_module_total
-
-            median_strength_of_module = \
-                np.median(  #
-                    total_related_genes_of_all_cells[mask_of_strong_cells_of_module])
-            strong_cells_count = np.sum(mask_of_strong_cells_of_module)
+            strong_cells_count = strong_cells_count_of_modules[module_index]
 
             if strong_cells_count > max_cells_of_modules:
                 if ut.logging_calc():
                     ut.log_calc('strong_cells',
                                 ut.mask_description(  #
-                                    mask_of_strong_cells_of_module)
+                                    mask_of_strong_cells_of_modules[:, module_index])
                                 + ' (too many)')
                 related_gene_indices_of_module.clear()
                 continue
@@ -553,19 +594,80 @@ def _identify_cells(
                 if ut.logging_calc():
                     ut.log_calc('strong_cells',
                                 ut.mask_description(  #
-                                    mask_of_strong_cells_of_module)
+                                    mask_of_strong_cells_of_modules[:, module_index])
                                 + ' (too few)')
                 related_gene_indices_of_module.clear()
                 continue
 
-            ut.log_calc('strong_cells', mask_of_strong_cells_of_module)
+            ut.log_calc('strong_cells', mask_of_strong_cells_of_modules[:, module_index])
+            mask_of_used_modules[module_index] = True
+
+    used_module_indices = np.flatnonzero(mask_of_used_modules)
+    if used_module_indices.size == 0:
+        return
+
+    total_related_genes_of_all_cells_of_used_modules = \
+        total_related_genes_of_all_cells_of_modules[:, used_module_indices]
+    mask_of_strong_cells_of_used_modules = \
+        mask_of_strong_cells_of_modules[:, used_module_indices]
+
+    median_strength_of_used_modules = \
+        np.nanmedian(np.where(mask_of_strong_cells_of_used_modules,
+                              total_related_genes_of_all_cells_of_used_modules,
+                              np.nan),
+                     axis=0)
+    strength_of_all_cells_of_used_modules = \
+        np.where(mask_of_strong_cells_of_used_modules,
+                 total_related_genes_of_all_cells_of_used_modules
+                 / median_strength_of_used_modules[None, :],
+                 -np.inf)
+
+    # Each cell is assigned to the module it is the strongest in. In case of ties, we pick the last
+    # such module, as if we went over the modules in order, and each one overrode the previous ones.
+    used_modules_count = used_module_indices.size
+    strongest_used_module_of_cells = \
+        used_modules_count - 1 \
+        - np.argmax(strength_of_all_cells_of_used_modules[:, ::-1], axis=1)
+    mask_of_strong_cells = np.any(mask_of_strong_cells_of_used_modules, axis=1)
+    rare_module_of_cells[mask_of_strong_cells] = \
+        used_module_indices[strongest_used_module_of_cells[mask_of_strong_cells]]
+
 
-            strength_of_all_cells = total_related_genes_of_all_cells / median_strength_of_module
-            mask_of_strong_cells_of_module &= strength_of_all_cells >= max_strength_of_cells
-            max_strength_of_cells[mask_of_strong_cells_of_module] = \
-                strength_of_all_cells[mask_of_strong_cells_of_module]
+@ut.timed_call()
+def _sum_modules_of_cells(
+    *,
+    adata_of_all_genes_of_all_cells: AnnData,
+    what: Union[str, ut.Matrix] = '__x__',
+    related_gene_indices_of_modules: List[List[int]],
+) -> ut.NumpyMatrix:
+    cells_count = adata_of_all_genes_of_all_cells.n_obs
+    modules_count = len(related_gene_indices_of_modules)
 
-            rare_module_of_cells[mask_of_strong_cells_of_module] = module_index
+    data = ut.get_vo_proper(adata_of_all_genes_of_all_cells, what,
+                            layout='row_major')
+
+    # A gene may be related to more than one module, so this is a (dense) genes-by-modules indicator
+    # matrix rather than a simple module index per gene. Multiplying the data of the used genes by
+    # it sums all the modules in a single pass, instead of slicing the matrix for each module.
+    gene_indices = np.concatenate([np.array(related_gene_indices_of_module, dtype='int64')
+                                   for related_gene_indices_of_module
+                                   in related_gene_indices_of_modules]
+                                  + [np.empty(0, dtype='int64')])
+    module_indices = np.repeat(np.arange(modules_count),
+                               [len(related_gene_indices_of_module)
+                                for related_gene_indices_of_module
+                                in related_gene_indices_of_modules])
+    used_gene_indices, used_gene_positions = \
+        np.unique(gene_indices, return_inverse=True)
+    modules_of_used_genes = \
+        np.zeros((used_gene_indices.size, modules_count), dtype='float32')
+    modules_of_used_genes[used_gene_positions, module_indices] = 1
+
+    with ut.timed_step('.sum_modules'):
+        ut.timed_parameters(cells=cells_count, genes=used_gene_indices.size,
+                            modules=modules_count)
+        totals = ut.to_numpy_matrix(data[:, used_gene_indices] @ modules_of_used_genes)
+    return totals
 
 
 @ut.timed_call()
@@ -664,27 +766,25 @@ def _results(
     assert np.max(rare_module_of_cells) \
         == len(list_of_rare_gene_indices_of_modules) - 1
 
-    if not inplace:
-        var_metrics = ut.to_pandas_frame(index=adata.var_names)
+    modules_count = len(list_of_rare_gene_indices_of_modules)
+    property_names = [f'rare_gene_module_{module_index}'
+                      for module_index in range(modules_count)] + ['rare_gene']
 
-    rare_gene_mask = np.zeros(adata.n_vars, dtype='bool')
+    # Collect all the masks in a single matrix, so we can create the results frame at once, rather
+    # than adding its columns one at a time.
+    masks_of_genes = np.zeros((adata.n_vars, modules_count + 1), dtype='bool', order='F')
     for module_index, rare_gene_indices_of_module \
             in enumerate(list_of_rare_gene_indices_of_modules):
-        rare_module_gene_mask = np.zeros(adata.n_vars, dtype='bool')
-        rare_module_gene_mask[rare_gene_indices_of_module] = True
-        property_name = f'rare_gene_module_{module_index}'
+        masks_of_genes[rare_gene_indices_of_module, module_index] = True
+    np.any(masks_of_genes[:, :-1], axis=1, out=masks_of_genes[:, -1])
+
+    # Copy each column, so the per-gene annotations do not share (and keep alive) a single buffer.
+    for property_index, property_name in enumerate(property_names):
         if inplace:
-            ut.set_v_data(adata, property_name, rare_module_gene_mask)
+            ut.set_v_data(adata, property_name,
+                          masks_of_genes[:, property_index].copy())
         else:
-            var_metrics[property_name] = rare_module_gene_mask
-            ut.log_return(property_name, rare_module_gene_mask)
-        rare_gene_mask |= rare_module_gene_mask
-
-    if inplace:
-        ut.set_v_data(adata, 'rare_gene', rare_gene_mask)
-    else:
-        var_metrics['rare_gene'] = rare_gene_mask
-        ut.log_return('rare_gene', rare_gene_mask)
+            ut.log_return(property_name, masks_of_genes[:, property_index])
 
     if inplace:
         ut.set_o_data(adata, 'cells_rare_gene_module', rare_module_of_cells,
@@ -692,7 +792,12 @@ def _results(
         ut.set_o_data(adata, 'rare_cell', rare_module_of_cells >= 0)
         return None
 
+    var_metrics = ut.to_pandas_frame(masks_of_genes, index=adata.var_names,
+                                     columns=property_names)
+
     obs_metrics = ut.to_pandas_frame(index=adata.obs_names)
+    obs_metrics['cells_rare_gene_module'] = rare_module_of_cells
+    obs_metrics['rare_cell'] = rare_module_of_cells >= 0
     ut.log_return('cells_rare_gene_module', rare_module_of_cells,
                   formatter=ut.groups_description)
     ut.log_return('rare_cell', rare_module_of_cells >= 0)
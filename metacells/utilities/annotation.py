@@ -62,6 +62,7 @@ level, while higher logging level give insight into the exact data being read an
 algorithm's nested sub-steps.
 '''
 
+import builtins
 from typing import (Any, Callable, Collection, Dict, List, MutableMapping,
                     Optional, Tuple, Union)
 
@@ -155,35 +156,35 @@ def slice(  # pylint: disable=redefined-builtin,too-many-branches,too-many-state
     '''
     assert '__x__' not in adata.layers
 
-    is_same_obs: Optional[bool] = None
     if obs is None:
-        obs = range(adata.n_obs)
+        obs = builtins.slice(None)
         is_same_obs = True
     else:
         assert 0 < len(obs) <= adata.n_obs
-        if len(obs) < adata.n_obs:
-            is_same_obs = False
-
         obs = utt.to_numpy_vector(obs)
         if obs.dtype == 'bool':
             assert obs.size == adata.n_obs
-            assert np.any(obs)
-            is_same_obs = bool(np.all(obs))
+            selected_count = np.count_nonzero(obs)
+            assert selected_count > 0
+            is_same_obs = selected_count == adata.n_obs
+        else:
+            is_same_obs = obs.size == adata.n_obs \
+                and bool(np.all(obs == np.arange(adata.n_obs)))
 
-    is_same_vars: Optional[bool] = None
     if vars is None:
-        vars = range(adata.n_vars)
+        vars = builtins.slice(None)
         is_same_vars = True
     else:
         assert 0 < len(vars) <= adata.n_vars
-        if len(vars) < adata.n_vars:
-            is_same_vars = False
-
         vars = utt.to_numpy_vector(vars)
         if vars.dtype == 'bool':
             assert vars.size == adata.n_vars
-            assert np.any(vars)
-            is_same_vars = bool(np.all(vars))
+            selected_count = np.count_nonzero(vars)
+            assert selected_count > 0
+            is_same_vars = selected_count == adata.n_vars
+        else:
+            is_same_vars = vars.size == adata.n_vars \
+                and bool(np.all(vars == np.arange(adata.n_vars)))
 
     if is_same_obs and is_same_vars:
         bdata = copy_adata(adata, name=name, share_derived=share_derived,
@@ -199,7 +200,7 @@ def slice(  # pylint: disable=redefined-builtin,too-many-branches,too-many-state
 
         try:
             with utm.timed_step('adata.slice'):
-                bdata = adata[obs, vars].copy()
+                bdata = adata[_contiguous_slice(obs), _contiguous_slice(vars)].copy()
         finally:
             _replace_back(adata, replaced)
 
@@ -210,23 +211,6 @@ def slice(  # pylint: disable=redefined-builtin,too-many-branches,too-many-state
         if hasattr(bdata, '__derived__'):
             delattr(bdata, '__derived__')
 
-        if share_derived \
-                and (is_same_obs or is_same_obs is None) \
-                and (is_same_vars or is_same_vars is None):
-
-            if is_same_obs is None:
-                is_same_obs = bdata.n_obs == adata.n_obs \
-                    and bool(np.all(bdata.obs_names == adata.obs_names))
-
-            if is_same_vars is None:
-                is_same_vars = bdata.n_vars == adata.n_vars \
-                    and bool(np.all(bdata.var_names == adata.var_names))
-
-            if is_same_obs and is_same_vars:
-                if not hasattr(adata, '__derived__'):
-                    setattr(adata, '__derived__', {})
-                setattr(bdata, '__derived__', getattr(adata, '__derived__'))
-
         if top_level:
             utl.top_level(bdata)
 
@@ -235,39 +219,77 @@ def slice(  # pylint: disable=redefined-builtin,too-many-branches,too-many-state
             f'slice {get_name(adata, "unnamed")} into {get_name(bdata, "unnamed")} shape {bdata.shape}')
 
     if track_obs is not None:
-        set_o_data(bdata, track_obs, np.arange(adata.n_obs)[obs])
+        set_o_data(bdata, track_obs, _tracked_indices(adata.n_obs, obs))
 
     if track_var is not None:
-        set_v_data(bdata, track_var, np.arange(adata.n_vars)[vars])
+        set_v_data(bdata, track_var, _tracked_indices(adata.n_vars, vars))
 
     return bdata
 
 
+def _tracked_indices(size: int, selection: Any) -> utt.NumpyVector:
+    # Use the smallest integer type that can hold the indices (typically, 32 bits).
+    dtype = 'int32' if size < 2 ** 31 else 'int64'
+    return np.arange(size, dtype=dtype)[selection]
+
+
+def _contiguous_slice(selection: Any) -> Any:
+    # Slicing by a contiguous range is much cheaper than by a mask or an indices array, as it avoids
+    # the fancy indexing of each of the (possibly compressed) data members.
+    if not isinstance(selection, np.ndarray):
+        return selection
+
+    if selection.dtype == 'bool':
+        start = int(np.argmax(selection))
+        stop = selection.size - int(np.argmax(selection[::-1]))
+        if not np.all(selection[start:stop]):
+            return selection
+    else:
+        start = int(selection[0])
+        stop = int(selection[-1]) + 1
+        if start < 0 or stop - start != selection.size \
+                or not np.all(selection[1:] > selection[:-1]):
+            return selection
+
+    return builtins.slice(start, stop)
+
+
 @utm.timed_call()
 def _replace_with_layout(adata: AnnData, layout: str) -> Dict[str, utt.Matrix]:
     replaced: Dict[str, utt.Matrix] = {}
+    replacements: Dict[str, utt.Matrix] = {}
 
     matrix: utt.Matrix = adata.X  # type: ignore
     if not utt.is_layout(matrix, layout):
         replaced['__x__'] = matrix
-        adata.X = get_vo_proper(adata, '__x__', layout=layout)
+        replacements['__x__'] = get_vo_proper(adata, '__x__', layout=layout)
 
-    for name in adata.layers:
-        matrix = adata.layers[name]
+    for name, matrix in adata.layers.items():
         if not utt.is_layout(matrix, layout):
             replaced[name] = matrix
-            adata.layers[name] = get_vo_proper(adata, name, layout=layout)
+            replacements[name] = get_vo_proper(adata, name, layout=layout)
 
+    _set_matrices(adata, replacements)
     return replaced
 
 
 @utm.timed_call()
 def _replace_back(adata: AnnData, replaced: Dict[str, utt.Matrix]) -> None:
-    for name, matrix in replaced.items():
-        if name == '__x__':
-            adata.X = matrix
-        else:
-            adata.layers[name] = matrix
+    _set_matrices(adata, replaced)
+
+
+def _set_matrices(adata: AnnData, matrices: Dict[str, utt.Matrix]) -> None:
+    x_matrix = matrices.get('__x__')
+    if x_matrix is not None:
+        adata.X = x_matrix
+
+    if len(matrices) > (x_matrix is not None):
+        # Rebuild all the layers at once, instead of validating and updating them one at a time.
+        layers = dict(adata.layers)
+        for name, matrix in matrices.items():
+            if name != '__x__':
+                layers[name] = matrix
+        adata.layers = layers
 
 
 @utm.timed_call()
@@ -340,11 +362,8 @@ def has_data(
         return utt.matrix_layout(matrix) == layout \
             or f'vo:__x__:{layout}' in derived
 
-    for per, annotations in (('vo', adata.layers),
-                             ('oo', adata.obsp),
-                             ('vv', adata.varp),
-                             ('va', adata.obsm),
-                             ('oa', adata.varm)):
+    for per in ('vo', 'oo', 'vv', 'oa', 'va'):
+        annotations = getattr(adata, utl.MEMBER_OF_PER[per])
         if name not in annotations:
             continue
         if layout is None:
@@ -883,18 +902,18 @@ def _get_layout_data(
     name: Union[str, utt.Matrix],
     layout: Optional[str],
 ) -> Any:
-    data = _get_shaped_data(adata, per, annotations, shape=shape, name=name)
     if not isinstance(name, str):
+        data = _get_shaped_data(adata, per, annotations, shape=shape, name=name)
         if not utt.is_layout(data, layout):
             assert layout is not None
             data = utc.to_layout(name, layout=layout)
         return data
 
-    if utt.is_layout(data, layout):
-        return data
+    if layout is None:
+        return _get_shaped_data(adata, per, annotations, shape=shape, name=name)
 
     assert layout in utt.LAYOUT_OF_AXIS
-    layout_name = '%s:%s:%s' % (per, name, layout)
+    layout_name = f'{per}:{name}:{layout}'
 
     if not hasattr(adata, '__derived__'):
         derived: Dict[str, utt.ProperMatrix] = dict()
@@ -902,17 +921,21 @@ def _get_layout_data(
     else:
         derived = getattr(adata, '__derived__')
 
+    # If we have cached the data in the requested layout, there's no need to fetch (and freeze) the
+    # original data, which is known to be in the other layout.
     layout_data = derived.get(layout_name)
     if layout_data is not None:
         assert layout_data.shape == shape
         assert utt.is_layout(layout_data, layout)
-    else:
-        layout_data = utc.to_layout(data, layout=layout)
-        derived[layout_name] = layout_data
+        return layout_data
 
-    if not utt.frozen(layout_data):
-        utt.freeze(layout_data)
+    data = _get_shaped_data(adata, per, annotations, shape=shape, name=name)
+    if utt.is_layout(data, layout):
+        return data
 
+    layout_data = utc.to_layout(data, layout=layout)
+    utt.freeze(layout_data)
+    derived[layout_name] = layout_data
     return layout_data
 
 
@@ -928,12 +951,13 @@ def _get_shaped_data(
         if per == 'vo' and name == '__x__':
             data = _fix_data(adata.X)
         else:
-            if name not in annotations:  # type: ignore
-                raise _unknown_data(adata, name, per)
-            data = _fix_data(annotations[name])
+            try:
+                data = annotations[name]
+            except KeyError:
+                raise _unknown_data(adata, name, per)  # pylint: disable=raise-missing-from
+            data = _fix_data(data)
 
-        if not utt.frozen(data):
-            utt.freeze(data)
+        utt.freeze(data)
 
     else:
         if utt.is_1d(name):
@@ -951,28 +975,6 @@ def _fix_data(data: Any) -> Any:
     return data
 
 
-def _annotation_per(  # pylint: disable=too-many-return-statements
-    adata: AnnData, per: str
-) -> Annotations:
-    if per == 'm':
-        return adata.uns
-    if per == 'vo':
-        return adata.layers
-    if per == 'v':
-        return adata.var
-    if per == 'o':
-        return adata.obs
-    if per == 'vv':
-        return adata.varp
-    if per == 'oo':
-        return adata.obsp
-    if per == 'va':
-        return adata.varm
-    if per == 'oa':
-        return adata.obsm
-    raise ValueError('unknown per: %s' % per)
-
-
 def set_name(adata: AnnData, name: Optional[str]) -> None:
     '''
     Set the ``name`` of the data (for log messages).
@@ -980,8 +982,7 @@ def set_name(adata: AnnData, name: Optional[str]) -> None:
     If the name starts with ``.`` it is appended to the current name, if any.
     '''
     if name is None:
-        if '__name__' in adata.uns:
-            del adata.uns['__name__']
+        adata.uns.pop('__name__', None)
         return
 
     if name[0] == '.':
@@ -1034,8 +1035,7 @@ def set_o_data(
 
     if not isinstance(data, list):
         assert utt.is_canonical(data)
-        if not utt.frozen(data):
-            utt.freeze(data)
+        utt.freeze(data)
 
     adata.obs[name] = data
 
@@ -1055,8 +1055,7 @@ def set_v_data(
     utl.log_set(adata, 'v', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
     adata.var[name] = data
 
@@ -1076,9 +1075,9 @@ def set_oo_data(
     utl.log_set(adata, 'oo', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
+    _invalidate_derived(adata, 'oo', name)
     adata.obsp[name] = data
 
 
@@ -1097,9 +1096,9 @@ def set_vv_data(
     utl.log_set(adata, 'vv', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
+    _invalidate_derived(adata, 'vv', name)
     adata.varp[name] = data
 
 
@@ -1118,9 +1117,9 @@ def set_oa_data(
     utl.log_set(adata, 'oa', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
+    _invalidate_derived(adata, 'oa', name)
     adata.obsm[name] = data
 
 
@@ -1139,9 +1138,9 @@ def set_va_data(
     utl.log_set(adata, 'va', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
+    _invalidate_derived(adata, 'va', name)
     adata.varm[name] = data
 
 
@@ -1158,15 +1157,25 @@ def set_vo_data(
     utl.log_set(adata, 'vo', name, data, formatter=formatter)
 
     assert utt.is_canonical(data)
-    if not utt.frozen(data):
-        utt.freeze(data)
+    utt.freeze(data)
 
+    _invalidate_derived(adata, 'vo', name)
     if name == '__x__':
         adata.X = data
     else:
         adata.layers[name] = data
 
 
+def _invalidate_derived(adata: AnnData, per: str, name: str) -> None:
+    # Forget any cached relayouts (and sums) of the previous data of the same name.
+    derived = getattr(adata, '__derived__', None)
+    if derived:
+        prefix = f'{per}:{name}:'
+        for derived_name in [derived_name for derived_name in derived
+                             if derived_name.startswith(prefix)]:
+            del derived[derived_name]
+
+
 def _unknown_data(adata: AnnData, name: str, per: Optional[str] = None) -> KeyError:
     texts = ['unknown']
 
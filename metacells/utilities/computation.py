@@ -18,6 +18,7 @@ analysis pipeline.
 '''
 
 import re
+from functools import lru_cache
 from math import ceil, floor
 from re import Pattern
 from typing import (Any, Callable, Collection, List, Optional, Tuple, TypeVar,
@@ -30,6 +31,7 @@ import scipy.sparse as sp  # type: ignore
 
 import metacells.extensions as xt  # type: ignore
 import metacells.utilities.documentation as utd
+import metacells.utilities.parallel as utp
 import metacells.utilities.timing as utm
 import metacells.utilities.typing as utt
 
@@ -277,7 +279,13 @@ def _relayout_compressed(compressed: utt.CompressedMatrix) -> utt.CompressedMatr
                                   output_indptr),
                                  shape=compressed.shape)
 
-        sort_compressed_indices(compressed, force=True)
+        # When collected serially, the elements of each output band are already in order. Only
+        # collecting them in parallel requires sorting them. The extension collects serially if it
+        # uses less than two threads for the loop over the bands.
+        if min(utp.EXTENSION_THREADS_COUNT, matrix_bands_count) > 1:
+            sort_compressed_indices(compressed, force=True)
+        else:
+            compressed.has_sorted_indices = True
 
     compressed.has_canonical_format = True
 
@@ -412,6 +420,10 @@ def _corrcoef_fast(
     matrix: utt.Matrix,
     per: Optional[str],
 ) -> utt.NumpyMatrix:
+    compressed = utt.maybe_compressed_matrix(matrix)
+    if compressed is not None:
+        return _corrcoef_fast_compressed(compressed, per)
+
     per, dense = _get_dense_for('corrcoef', matrix, per)
     axis = utt.PER_OF_AXIS.index(per)
 
@@ -419,24 +431,55 @@ def _corrcoef_fast(
                          elements=dense.shape[1 - axis])
 
     with utt.unfrozen(dense):
-        # Replication of numpy code:
+        # Replication of numpy code, except we re-scale the result in a single pass using the
+        # outer product of the inverse row norms (which are the square roots of the diagonal).
         X = dense if per == 'row' else dense.T
         row_averages = np.average(X, axis=1)
         X -= row_averages[:, None]
         result = np.matmul(X, X.T)
-        result *= 1 / X.shape[1]
         X += row_averages[:, None]
-        diagonal = np.diag(result)
-        stddev = np.sqrt(diagonal)
-        stddev[stddev == 0] = 1
-        result /= stddev[:, None]
-        result /= stddev[None, :]
+        row_norms = np.sqrt(np.diag(result))
+        row_norms[row_norms == 0] = 1
+        inverse_row_norms = 1 / row_norms
+        result *= np.outer(inverse_row_norms, inverse_row_norms)
         np.clip(result, -1, 1, out=result)
         np.fill_diagonal(result, 1.0)
 
     return result
 
 
+@utm.timed_call('.compressed')
+def _corrcoef_fast_compressed(
+    compressed: utt.CompressedMatrix,
+    per: Optional[str],
+) -> utt.NumpyMatrix:
+    per = _ensure_per_for('corrcoef', compressed, per)
+    axis = utt.PER_OF_AXIS.index(per)
+    elements_count = compressed.shape[1 - axis]
+
+    utm.timed_parameters(results=compressed.shape[axis],
+                         elements=elements_count,
+                         nnz=compressed.nnz)
+
+    # Instead of centering the (sparse) data, which would make it dense, compute the products of the
+    # original rows using a sparse matrix multiplication, and center the (dense) result instead. This
+    # suffers from cancellation, so we do it in double precision.
+    X = compressed if per == 'row' else compressed.transpose()
+    X = X.astype('float64')
+    row_sums = utt.to_numpy_vector(X.sum(axis=1))
+    result = utt.to_numpy_matrix(X @ X.T)
+    result -= np.outer(row_sums, row_sums / elements_count)
+    row_norms = np.sqrt(np.maximum(np.diag(result), 0))
+    row_norms[row_norms == 0] = 1
+    result /= row_norms[:, None]
+    result /= row_norms[None, :]
+    np.clip(result, -1, 1, out=result)
+    np.fill_diagonal(result, 1.0)
+
+    # Like the dense computation, return single precision results only for single precision data.
+    return result.astype('float32' if compressed.dtype == 'float32' else 'float64', copy=False)
+
+
 @utm.timed_call('.dense')
 def _corrcoef_dense_matrix(
     dense: utt.NumpyMatrix,
@@ -912,6 +955,9 @@ def max_per(matrix: utt.Matrix, *, per: Optional[str]) -> utt.NumpyVector:
 
     sparse = utt.maybe_sparse_matrix(matrix)
     if sparse is not None:
+        if sparse.getformat() == ('csr', 'csc')[axis]:
+            return _reduce_matrix('max', sparse, per,
+                                  lambda sparse: _reduce_compressed(sparse, np.maximum))
         return _reduce_matrix('max', sparse, per, lambda sparse: sparse.max(axis=1 - axis))
 
     dense = utt.to_numpy_matrix(matrix, only_extract=True)
@@ -952,6 +998,9 @@ def min_per(matrix: utt.Matrix, *, per: Optional[str]) -> utt.NumpyVector:
 
     sparse = utt.maybe_sparse_matrix(matrix)
     if sparse is not None:
+        if sparse.getformat() == ('csr', 'csc')[axis]:
+            return _reduce_matrix('min', sparse, per,
+                                  lambda sparse: _reduce_compressed(sparse, np.minimum))
         return _reduce_matrix('min', sparse, per, lambda sparse: sparse.min(axis=1 - axis))
 
     dense = utt.to_numpy_matrix(matrix, only_extract=True)
@@ -1485,6 +1534,24 @@ def rank_matrix_by_layout(matrix: utt.NumpyMatrix, ascending: bool) -> Any:
 M = TypeVar('M', bound=utt.Matrix)
 
 
+def _reduce_compressed(compressed: utt.CompressedMatrix, ufunc: np.ufunc) -> utt.NumpyVector:
+    # Directly reduce the data of each row (or column) of a canonical compressed matrix in its
+    # efficient layout, taking into account the implicit zeros of each partially filled one.
+    indptr = compressed.indptr
+    sizes = np.diff(indptr)
+    elements_count = compressed.shape[1 - ('csr', 'csc').index(compressed.getformat())]
+
+    results = np.zeros(sizes.size, dtype=compressed.dtype)
+    filled_mask = sizes > 0
+    if np.any(filled_mask):
+        filled_results = ufunc.reduceat(compressed.data[:indptr[-1]], indptr[:-1][filled_mask])
+        partial_mask = sizes[filled_mask] < elements_count
+        filled_results[partial_mask] = ufunc(filled_results[partial_mask], 0)
+        results[filled_mask] = filled_results
+
+    return results
+
+
 def _reduce_matrix(
     _name: str,
     matrix: M,
@@ -1667,12 +1734,11 @@ def patterns_matches(
 
     utm.timed_parameters(patterns=len(patterns), strings=len(strings))
 
-    pattern: Pattern = \
-        re.compile('|'.join([alternative if isinstance(alternative, str)
-                             else alternative.pattern
-                             for alternative in patterns]))
+    pattern = _compile_patterns(tuple(alternative if isinstance(alternative, str)
+                                      else alternative.pattern
+                                      for alternative in patterns))
 
-    mask = np.array([bool(pattern.match(string)) for string in strings])
+    mask = np.fromiter(map(bool, map(pattern.match, strings)), dtype='bool', count=len(strings))
 
     if invert:
         mask = ~mask
@@ -1680,6 +1746,11 @@ def patterns_matches(
     return mask
 
 
+@lru_cache(maxsize=128)
+def _compile_patterns(patterns: Tuple[str, ...]) -> Pattern:
+    return re.compile('|'.join(patterns))
+
+
 @utm.timed_call()
 def compress_indices(indices: utt.Vector) -> utt.NumpyVector:
     '''
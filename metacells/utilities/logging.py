@@ -295,14 +295,20 @@ def logged(**kwargs: Callable[[Any], Any]) -> Callable[[CALLABLE], CALLABLE]:
                                    f'for the function: {function.__module__}.{function.__qualname__}')
         ordered_parameters = list(parameters.values())
 
+        step_name = function.__qualname__
+        if step_name[0] == '_':
+            step_name = step_name[1:]
+
         @wraps(function)
-        def wrapper(*args: Any, **kwargs: Any) -> Any:  # pylint: disable=too-many-branches
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
             global CALL_LEVEL
             global INDENT_LEVEL
             names, values = \
                 _collect_parameters(ordered_parameters, *args, **kwargs)
             adatas = _collect_adatas(values)
             new_adatas: List[AnnData] = []
+            log = logger()
+            is_step_logged = False
 
             try:
                 global IS_TOP_LEVEL
@@ -325,29 +331,27 @@ def logged(**kwargs: Callable[[Any], Any]) -> Callable[[CALLABLE], CALLABLE]:
                     step_level = DEBUG
                     param_level = DEBUG
 
-                name = function.__qualname__
-                if name[0] == '_':
-                    name = name[1:]
-                if logger().isEnabledFor(step_level):
-                    logger().log(step_level, '%scall %s:',
-                                 INDENT_SPACES[:2 * INDENT_LEVEL],
-                                 name)
+                is_step_logged = log.isEnabledFor(step_level)
+                if is_step_logged:
+                    log.log(step_level, '%scall %s:',
+                            INDENT_SPACES[:2 * INDENT_LEVEL],
+                            step_name)
                     INDENT_LEVEL += 1
                 CALL_LEVEL += 1
 
-                if logger().isEnabledFor(param_level):
+                if log.isEnabledFor(param_level):
                     for name, value in zip(names, values):
                         log_value = _format_value(value, name,
                                                   formatter_by_name.get(name))
                         if log_value is not None:
-                            logger().log(param_level, '%swith %s: %s',
-                                         INDENT_SPACES[:2 * INDENT_LEVEL],
-                                         name, log_value)
+                            log.log(param_level, '%swith %s: %s',
+                                    INDENT_SPACES[:2 * INDENT_LEVEL],
+                                    name, log_value)
 
                 return function(*args, **kwargs)
 
             finally:
-                if logger().isEnabledFor(step_level):
+                if is_step_logged:
                     INDENT_LEVEL -= 1
                 CALL_LEVEL -= 1
                 IS_TOP_LEVEL = old_is_top_level
@@ -612,6 +616,9 @@ def log_set(
         and (not hasattr(adata, '__incremental__')
              or not name in getattr(adata, '__incremental__'))
 
+    if not logger().isEnabledFor(INFO if is_top_level else DEBUG):
+        return False
+
     adata_name = adata.uns.get('__name__', 'unnamed')
     if name == '__x__':
         name = f'{adata_name}.X'
@@ -640,6 +647,9 @@ def log_get(
         and (not hasattr(adata, '__incremental__')
              or not name in getattr(adata, '__incremental__'))
 
+    if not logger().isEnabledFor(CALC if is_top_level else DEBUG):
+        return False
+
     adata_name = adata.uns.get('__name__', 'unnamed')
     if isinstance(name, str) and name == '__x__':
         name = f'{adata_name}.X'
@@ -54,10 +54,12 @@ FreeBSD, Mac OSX and Windows, but YMMV.
     Re-implement all the package in a single language more suitable for scientific computing. Julia
     is looking like a good combination of convenience and performance...
 '''
-import ctypes
+import gc
 import os
 import sys
-from multiprocessing import Pool, Value
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.queues import SimpleQueue
 from threading import current_thread
 from typing import Any, Callable, Iterable, Optional, TypeVar
 
@@ -79,15 +81,18 @@ __all__ = [
 
 PROCESSORS_COUNT = 0
 
+#: The number of threads we last allowed the C++ extensions to use.
+EXTENSION_THREADS_COUNT = 1
+
 MAIN_PROCESS_PID = os.getpid()
 
-IS_MAIN_PROCESS: Optional[bool] = True
+IS_MAIN_PROCESS = True
 
 MAP_INDEX = 0
 PROCESS_INDEX = 0
 
 PROCESSES_COUNT = 0
-NEXT_PROCESS_INDEX = Value(ctypes.c_int32, lock=True)
+PROCESS_INDICES: Optional[SimpleQueue] = None
 PARALLEL_FUNCTION: Optional[Callable[[int], Any]] = None
 
 
@@ -96,7 +101,7 @@ def is_main_process() -> bool:
     Return whether this is the main process, as opposed to a sub-process spawned by
     :py:func:`parallel_map`.
     '''
-    return bool(IS_MAIN_PROCESS)
+    return IS_MAIN_PROCESS
 
 
 def set_processors_count(processors: int) -> None:
@@ -107,6 +112,8 @@ def set_processors_count(processors: int) -> None:
     hyper-threading is enabled, this would be less than (typically half of) the number of logical
     processors in the system. This is intentional, as there's no value - actually, negative
     value - in running multiple heavy computations on hyper-threads of the same physical processor.
+    This is further restricted to the number of processors this process is allowed to run on (e.g.
+    due to ``taskset`` or a batch job scheduler), where the operating system provides it.
 
     Otherwise, the value is the actual (positive) number of processors to use. Override this by
     setting the ``METACELLS_PROCESSORS_COUNT`` environment variable or by invoking this function
@@ -115,15 +122,54 @@ def set_processors_count(processors: int) -> None:
     assert IS_MAIN_PROCESS
 
     if processors == 0:
-        processors = uth.hardware_info().get('cpus', os.cpu_count())
+        available_processors = _available_processors()
+        processors = min(uth.hardware_info().get('cpus', available_processors),
+                         available_processors)
 
     assert processors > 0
 
     global PROCESSORS_COUNT
     PROCESSORS_COUNT = processors
 
-    threadpool_limits(limits=PROCESSORS_COUNT)
-    xt.set_threads_count(PROCESSORS_COUNT)
+    _limit_threads(PROCESSORS_COUNT)
+    _set_extension_threads_count(PROCESSORS_COUNT)
+
+
+def _set_extension_threads_count(threads: int) -> None:
+    # The extension decides whether to run each loop serially based on this, so we track it to be
+    # able to tell what the extension did.
+    global EXTENSION_THREADS_COUNT
+    EXTENSION_THREADS_COUNT = threads
+    xt.set_threads_count(threads)
+
+
+def _available_processors() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _limit_threads(processors: int) -> None:
+    # Limit BLAS and OpenMP separately, so we never raise the number of threads above an explicit
+    # limit given to either in the environment.
+    threadpool_limits(limits=dict(
+        blas=_max_threads(processors, 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'),
+        openmp=_max_threads(processors, 'OMP_NUM_THREADS')
+    ))
+
+
+def _max_threads(processors: int, *variables: str) -> int:
+    for variable in variables:
+        # OpenMP allows a comma-separated list of values for nested levels; only the first one
+        # applies to us. Ignore values we can't make sense of rather than failing to import.
+        value = os.environ.get(variable, '').split(',')[0].strip()
+        try:
+            threads = int(value)
+        except ValueError:
+            continue
+        if threads > 0:
+            processors = min(processors, threads)
+    return max(processors, 1)
 
 
 if not 'sphinx' in sys.argv[0]:
@@ -148,6 +194,7 @@ def parallel_map(
     invocations: int,
     *,
     max_processors: int = 0,
+    releases_gil: bool = False,
 ) -> Iterable[T]:
     '''
     Execute ``function``, in parallel, ``invocations`` times. Each invocation is given the
@@ -168,14 +215,28 @@ def parallel_map(
     memory copy(-on-write) of the full Python state, that is, all the inputs for the function are
     available "for free".
 
+    If ``releases_gil`` (default: {releases_gil}), then the function is assumed to spend most of its
+    time in compiled code which releases the GIL (e.g. large numpy operations or our own C++
+    extension functions). In this case, the invocations are executed by parallel threads of the
+    current process instead, avoiding the cost of forking the processes. While these threads are
+    running, the internal threads of numpy are limited so the total will be at most
+    :py:func:`get_processors_count`, and our extension functions run serially (they do not support
+    running several parallel loops at the same time).
+
+    .. note::
+
+        We deliberately fork a new pool of processes for each invocation rather than reusing a
+        persistent pool of worker processes (e.g. ``loky``'s reusable executor). Reused workers
+        would not see the state created since they were forked, so all the inputs would have to be
+        pickled and sent to them, which for our large data would cost much more than the fork.
+
     .. todo::
 
         It is currently only possible to invoke :py:func:`parallel_map` from the main application
         thread (that is, it does not nest).
     '''
-    assert function.__is_timed__  # type: ignore
+    assert not utm.COLLECT_TIMING or getattr(function, '__is_timed__', False)
 
-    global IS_MAIN_PROCESS
     assert IS_MAIN_PROCESS
 
     global PROCESSES_COUNT
@@ -187,52 +248,95 @@ def parallel_map(
     if PROCESSES_COUNT == 1:
         return [function(index) for index in range(invocations)]
 
-    NEXT_PROCESS_INDEX.value = 0
+    global MAP_INDEX
+    MAP_INDEX += 1
+
+    if releases_gil:
+        return _threads_map(function, invocations)
+
+    # We rely on the processes being forked (and not started using a fork server or spawned) as this
+    # gives them access to the function and all its inputs without pickling them.
+    fork = get_context('fork')
+
+    # Each forked process takes its index from this queue when it first runs.
+    global PROCESS_INDICES
+    PROCESS_INDICES = fork.SimpleQueue()
+    for process_index in range(PROCESSES_COUNT):
+        PROCESS_INDICES.put(process_index)
 
     global PARALLEL_FUNCTION
     assert PARALLEL_FUNCTION is None
 
-    global MAP_INDEX
-    MAP_INDEX += 1
-
     PARALLEL_FUNCTION = function
-    IS_MAIN_PROCESS = None
     try:
         utm.flush_timing()
         with utm.timed_step('parallel_map'):
             utm.timed_parameters(index=MAP_INDEX, processes=PROCESSES_COUNT)
-            with Pool(PROCESSES_COUNT) as pool:
-                return pool.map(_invocation, range(invocations))
+            # Hand each process a few contiguous batches of invocations, to amortize the IPC cost,
+            # while still leaving some room for balancing the load between the processes.
+            batches_count = PROCESSES_COUNT * 4
+            chunksize = max(1, (invocations + batches_count - 1) // batches_count)
+            # Move all the current objects to the permanent GC generation, so garbage collections
+            # in the forked processes will not touch them, which would unshare their memory pages.
+            gc.freeze()
+            with fork.Pool(PROCESSES_COUNT, initializer=_initialize_process) as pool:
+                return pool.map(_invocation, range(invocations), chunksize=chunksize)
     finally:
-        IS_MAIN_PROCESS = True
+        gc.unfreeze()
         PARALLEL_FUNCTION = None
+        PROCESS_INDICES = None
 
 
-def _invocation(index: int) -> Any:
+def _threads_map(function: Callable[[int], T], invocations: int) -> Iterable[T]:
+    # All the threads share the (process-wide) limits on the internal threads of numpy, so we split
+    # the processors between them for the duration of the map. Our extensions keep the state of
+    # their parallel loops in static variables, so concurrent parallel loops would clobber each
+    # other; we therefore force them to run serially for the duration of the map.
+    threads_processors = max(1, PROCESSORS_COUNT // PROCESSES_COUNT)
+    try:
+        with utm.timed_step('parallel_map'):
+            utm.timed_parameters(index=MAP_INDEX, threads=PROCESSES_COUNT)
+            _limit_threads(threads_processors)
+            _set_extension_threads_count(1)
+            with ThreadPoolExecutor(PROCESSES_COUNT,
+                                    thread_name_prefix='#%s' % MAP_INDEX,
+                                    initializer=utm.in_parallel_thread,
+                                    initargs=(utm.current_step(),)) as executor:
+                return list(executor.map(function, range(invocations)))
+    finally:
+        _limit_threads(PROCESSORS_COUNT)
+        _set_extension_threads_count(PROCESSORS_COUNT)
+
+
+def _initialize_process() -> None:
     global IS_MAIN_PROCESS
-    if IS_MAIN_PROCESS is None:
-        IS_MAIN_PROCESS = os.getpid() == MAIN_PROCESS_PID
-        assert not IS_MAIN_PROCESS
-
-        global PROCESS_INDEX
-        global NEXT_PROCESS_INDEX
-        with NEXT_PROCESS_INDEX:  # type: ignore
-            PROCESS_INDEX = NEXT_PROCESS_INDEX.value
-            NEXT_PROCESS_INDEX.value += 1
-
-        current_thread().name = '#%s.%s' % (MAP_INDEX, PROCESS_INDEX)
-
-        global PROCESSORS_COUNT
-        start_processor_index = \
-            int(round(PROCESSORS_COUNT * PROCESS_INDEX / PROCESSES_COUNT))
-        stop_processor_index = \
-            int(round(PROCESSORS_COUNT * (PROCESS_INDEX + 1) / PROCESSES_COUNT))
-        PROCESSORS_COUNT = stop_processor_index - start_processor_index
-
-        assert PROCESSORS_COUNT > 0
-        utl.logger().debug('PROCESSORS: %s', PROCESSORS_COUNT)
-        threadpool_limits(limits=PROCESSORS_COUNT)
-        xt.set_threads_count(PROCESSORS_COUNT)
+    IS_MAIN_PROCESS = os.getpid() == MAIN_PROCESS_PID
+    assert not IS_MAIN_PROCESS
+
+    global PROCESS_INDEX
+    assert PROCESS_INDICES is not None
+    PROCESS_INDEX = PROCESS_INDICES.get()
+
+    current_thread().name = '#%s.%s' % (MAP_INDEX, PROCESS_INDEX)
+
+    global PROCESSORS_COUNT
+    start_processor_index = \
+        int(round(PROCESSORS_COUNT * PROCESS_INDEX / PROCESSES_COUNT))
+    stop_processor_index = \
+        int(round(PROCESSORS_COUNT * (PROCESS_INDEX + 1) / PROCESSES_COUNT))
+    PROCESSORS_COUNT = stop_processor_index - start_processor_index
+
+    assert PROCESSORS_COUNT > 0
+    utl.logger().debug('PROCESSORS: %s', PROCESSORS_COUNT)
+    _limit_threads(PROCESSORS_COUNT)
+    _set_extension_threads_count(PROCESSORS_COUNT)
 
     assert PARALLEL_FUNCTION is not None
-    return PARALLEL_FUNCTION(index)
+
+
+def _invocation(index: int) -> Any:
+    try:
+        return PARALLEL_FUNCTION(index)  # type: ignore
+    finally:
+        # Worker processes are terminated without running exit handlers.
+        utm.flush_timing()
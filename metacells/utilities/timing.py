@@ -9,15 +9,18 @@ information about all functions which has higher overheads and produces mountain
 irrelevant data.
 '''
 
+import atexit
+import gc
 import os
 import sys
-from contextlib import contextmanager
-from functools import wraps
-from threading import current_thread
+from contextlib import nullcontext
+from copy import copy
+from functools import lru_cache, wraps
+from threading import RLock, current_thread
 from threading import local as thread_local
 from time import perf_counter_ns, process_time_ns
-from typing import (IO, Any, Callable, Dict, Iterator, List, NamedTuple,
-                    Optional, TypeVar)
+from typing import (Any, Callable, ContextManager, Dict, List,
+                    NamedTuple, Optional, TypeVar)
 
 import metacells.utilities.documentation as utd
 import metacells.utilities.logging as utl
@@ -26,6 +29,7 @@ __all__ = [
     'collect_timing',
     'flush_timing',
     'in_parallel_map',
+    'in_parallel_thread',
     'log_steps',
     'timed_step',
     'timed_call',
@@ -41,7 +45,23 @@ COLLECT_TIMING = False
 TIMING_PATH = 'timing.csv'
 TIMING_MODE = 'a'
 TIMING_BUFFERING = 1
-TIMING_FILE: Optional[IO] = None
+TIMING_FD: Optional[int] = None
+
+#: The flags for opening the timing file for each of the supported modes.
+TIMING_FLAGS = dict(a=os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                    w=os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+#: The number of timing lines we accumulate before writing them to the timing file.
+TIMING_BATCH = 64
+TIMING_LINES: List[str] = []
+
+#: Protects ``TIMING_LINES`` against concurrent timed steps in several threads. This is re-entrant
+#: since a garbage collection (which is also timed) may happen while writing the lines.
+TIMING_LOCK = RLock()
+
+#: Steps whose elapsed time is shorter than this do not bother to read the CPU time when they end,
+#: and instead report their elapsed time as their CPU time.
+SHORT_STEP_NS = 10_000
 
 LOG_ALL_STEPS = False
 
@@ -64,12 +84,22 @@ def collect_timing(
     variable to ``true``, or by invoking this function from the main thread.
 
     By default, the data is written to the ``path`` is {path}, which is opened with the mode is
-    {mode} and using the buffering is {buffering}. Override this by setting the
-    ``METACELL_TIMING_PATH``, ``METACELL_TIMING_MODE`` and/or the ``METACELL_TIMING_BUFFERING``
-    environment variables, or by invoking this function from the main thread.
+    {mode} (either ``a`` to append to or ``w`` to overwrite the file). Override this by setting the
+    ``METACELL_TIMING_PATH`` and/or ``METACELL_TIMING_MODE`` environment variables, or by invoking
+    this function from the main thread.
 
     This will flush and close the previous timing file, if any.
 
+    The lines are written in batches directly to the file descriptor (bypassing Python's buffered
+    I/O). Since the file is opened for appending, each batch of complete lines is written using a
+    single system call, even if several processes are writing to the same file.
+
+    .. note::
+
+        The ``buffering`` (and the ``METACELL_TIMING_BUFFERING`` environment variable) are
+        deprecated. They are still accepted for backward compatibility, but are ignored, since the
+        batches of lines take the place of the I/O buffering.
+
     The file is written in CSV format (without headers). The first three fields are:
 
     * The invocation context (a ``.``-separated path of "relevant" function/step names).
@@ -86,25 +116,36 @@ def collect_timing(
     global TIMING_PATH
     global TIMING_MODE
     global TIMING_BUFFERING
-    global TIMING_FILE
+    global TIMING_FD
     global COLLECT_TIMING
 
     if not path.endswith('.csv'):
         raise ValueError('The METACELL_TIMING_PATH: %s does not end with: .csv'
                          % path)
 
+    if mode not in TIMING_FLAGS:
+        raise ValueError('The METACELL_TIMING_MODE: %s is not one of: %s'
+                         % (mode, ', '.join(TIMING_FLAGS.keys())))
+
+    if TIMING_LINES:
+        _write_timing_lines()
+
     TIMING_PATH = path
     TIMING_MODE = mode
     TIMING_BUFFERING = buffering
 
-    if TIMING_FILE is not None:
-        TIMING_FILE.flush()
-        TIMING_FILE.close()
-        TIMING_FILE = None
+    if TIMING_FD is not None:
+        os.close(TIMING_FD)
+        TIMING_FD = None
 
     if collect:
-        TIMING_FILE = open(TIMING_PATH, TIMING_MODE,
-                           buffering=TIMING_BUFFERING)
+        TIMING_FD = os.open(TIMING_PATH, TIMING_FLAGS[TIMING_MODE], 0o644)
+
+    # Only pay for sampling the counters around garbage collections while we are collecting timing.
+    if collect and not COLLECT_TIMING:
+        gc.callbacks.append(_time_gc)
+    elif COLLECT_TIMING and not collect:
+        gc.callbacks.remove(_time_gc)
 
     COLLECT_TIMING = collect
 
@@ -113,8 +154,11 @@ def flush_timing() -> None:
     '''
     Flush the timing information, if we are collecting it.
     '''
-    if TIMING_FILE is not None:
-        TIMING_FILE.flush()
+    if TIMING_LINES:
+        _write_timing_lines()
+
+
+atexit.register(flush_timing)
 
 
 def in_parallel_map(map_index: int, process_index: int) -> None:
@@ -140,6 +184,25 @@ def in_parallel_map(map_index: int, process_index: int) -> None:
                        % (TIMING_PATH[:-4], map_index, process_index))
 
 
+def in_parallel_thread(step_timing: Optional['StepTiming']) -> None:
+    '''
+    Reconfigure timing collection when running in a parallel thread via
+    :py:func:`metacells.utilities.parallel.parallel_map` (when it ``releases_gil``).
+
+    The steps of the thread are nested in the context of the ``step_timing`` (if any) which invoked
+    the map, just like the steps of sub-processes are. However, the time of these steps is not
+    subtracted from the time of the ``step_timing``, since the threads run at the same time.
+    '''
+    steps_stack: List[StepTiming] = []
+    if step_timing is not None:
+        thread_timing = copy(step_timing)
+        thread_timing.parameters = []
+        thread_timing.thread_name = current_thread().name
+        thread_timing.total_nested = Counters()
+        steps_stack.append(thread_timing)
+    THREAD_LOCAL.steps_stack = steps_stack
+
+
 def log_steps(log: bool) -> None:
     '''
     Whether to log every step invocation.
@@ -158,52 +221,28 @@ def log_steps(log: bool) -> None:
     LOG_ALL_STEPS = log
 
 
-if not 'sphinx' in sys.argv[0]:
-    TIMING_PATH = os.environ.get('METACELL_TIMING_CSV', TIMING_PATH)
-    TIMING_MODE = os.environ.get('METACELL_TIMING_MODE', TIMING_MODE)
-    TIMING_BUFFERING = \
-        int(os.environ.get('METACELL_TIMING_BUFFERING', str(TIMING_BUFFERING)))
-    collect_timing({'true': True,
-                    'false': False}[os.environ.get('METACELLS_COLLECT_TIMING',
-                                                   str(COLLECT_TIMING)).lower()])
-    log_steps({'true': True,
-               'false': False}[os.environ.get('METACELLS_LOG_ALL_STEPS',
-                                              str(LOG_ALL_STEPS)).lower()])
-
-
-class Counters:
+class Counters(NamedTuple):
     '''
     The counters for the execution times.
     '''
 
-    def __init__(self, *, elapsed_ns: int = 0, cpu_ns: int = 0) -> None:
-        self.elapsed_ns = elapsed_ns  #: Elapsed time counter.
-        self.cpu_ns = cpu_ns  #: CPU time counter.
+    elapsed_ns: int = 0  #: Elapsed time counter.
+    cpu_ns: int = 0  #: CPU time counter.
 
     @staticmethod
     def now() -> 'Counters':
         '''
         Return the current value of the counters.
         '''
-        return Counters(elapsed_ns=perf_counter_ns(), cpu_ns=process_time_ns())
-
-    def __add__(self, other: 'Counters') -> 'Counters':
-        return Counters(elapsed_ns=self.elapsed_ns + other.elapsed_ns,
-                        cpu_ns=self.cpu_ns + other.cpu_ns)
+        return Counters(perf_counter_ns(), process_time_ns())
 
-    def __iadd__(self, other: 'Counters') -> 'Counters':
-        self.elapsed_ns += other.elapsed_ns
-        self.cpu_ns += other.cpu_ns
-        return self
+    def __add__(self, other: 'Counters') -> 'Counters':  # type: ignore
+        return Counters(self.elapsed_ns + other.elapsed_ns,
+                        self.cpu_ns + other.cpu_ns)
 
     def __sub__(self, other: 'Counters') -> 'Counters':
-        return Counters(elapsed_ns=self.elapsed_ns - other.elapsed_ns,
-                        cpu_ns=self.cpu_ns - other.cpu_ns)
-
-    def __isub__(self, other: 'Counters') -> 'Counters':
-        self.elapsed_ns -= other.elapsed_ns
-        self.cpu_ns -= other.cpu_ns
-        return self
+        return Counters(self.elapsed_ns - other.elapsed_ns,
+                        self.cpu_ns - other.cpu_ns)
 
 
 class StepTiming:
@@ -218,15 +257,8 @@ class StepTiming:
         #: The parent step, if any.
         self.parent = parent
 
-        if name[0] != '.':
-            name = ';' + name
-
-        if parent is None:
-            assert not name[0] == '.'
-            name = name[1:]
-
         #: The full context of the processing step.
-        self.context: str = name if parent is None else parent.context + name
+        self.context = _step_context(None if parent is None else parent.context, name)
 
         #: Parameters of interest of the processing step.
         self.parameters: List[str] = []
@@ -238,6 +270,31 @@ class StepTiming:
         self.total_nested = Counters()
 
 
+@lru_cache(maxsize=1024)
+def _step_context(parent_context: Optional[str], name: str) -> str:
+    # The same steps are nested in the same way over and over again, so we cache the full context
+    # instead of building a new string for each step invocation.
+    if name[0] == '_':
+        name = f'.{name[1:]}'
+
+    if parent_context is None:
+        assert name[0] != '.'
+        return name
+
+    if name[0] != '.':
+        name = ';' + name
+    return parent_context + name
+
+
+def _steps_stack() -> List[StepTiming]:
+    try:
+        return THREAD_LOCAL.steps_stack
+    except AttributeError:
+        steps_stack: List[StepTiming] = []
+        THREAD_LOCAL.steps_stack = steps_stack
+        return steps_stack
+
+
 class GcStep(NamedTuple):
     '''
     Data about a GC collection step.
@@ -250,43 +307,40 @@ class GcStep(NamedTuple):
     stop: Counters
 
 
-if COLLECT_TIMING:
-    import gc
+GC_STEPS: List[GcStep] = []
+
+GC_START_POINT: Optional[Counters] = None
 
-    GC_STEPS: List[GcStep] = []
 
-    GC_START_POINT: Optional[Counters] = None
+def _time_gc(phase: str, info: Dict[str, Any]) -> None:
+    if not _steps_stack():
+        return
 
-    def _time_gc(phase: str, info: Dict[str, Any]) -> None:
-        steps_stack = getattr(THREAD_LOCAL, 'steps_stack', None)
-        if not steps_stack:
-            return
+    global GC_START_POINT
+    if phase == 'start':
+        assert GC_START_POINT is None
+        GC_START_POINT = Counters.now()
+        return
 
-        global GC_START_POINT
-        if phase == 'start':
-            assert GC_START_POINT is None
-            GC_START_POINT = Counters.now()
-            return
+    assert phase == 'stop'
+    assert GC_START_POINT is not None
 
-        assert phase == 'stop'
-        assert GC_START_POINT is not None
+    gc_step = GcStep(start=GC_START_POINT, stop=Counters.now())
+    GC_STEPS.append(gc_step)
+    GC_START_POINT = None
 
-        gc_step = GcStep(start=GC_START_POINT, stop=Counters.now())
-        GC_STEPS.append(gc_step)
-        GC_START_POINT = None
+    gc_parameters = []
+    for name, value in info.items():
+        gc_parameters.append(name)
+        gc_parameters.append(str(value))
 
-        gc_parameters = []
-        for name, value in info.items():
-            gc_parameters.append(name)
-            gc_parameters.append(str(value))
+    _print_timing('__gc__', gc_step.stop - gc_step.start, gc_parameters)
 
-        _print_timing('__gc__', gc_step.stop - gc_step.start, gc_parameters)
 
-    gc.callbacks.append(_time_gc)
+NO_TIMING = nullcontext()
 
 
-@contextmanager
-def timed_step(name: str) -> Iterator[None]:  # pylint: disable=too-many-branches
+def timed_step(name: str) -> ContextManager[None]:
     '''
     Collect timing information for a computation step.
 
@@ -312,33 +366,42 @@ def timed_step(name: str) -> Iterator[None]:  # pylint: disable=too-many-branche
     function.
     '''
     if not COLLECT_TIMING:
-        yield None
-        return
+        return NO_TIMING
+    return _TimedStep(name)
 
-    steps_stack = getattr(THREAD_LOCAL, 'steps_stack', None)
-    if steps_stack is None:
-        steps_stack = THREAD_LOCAL.steps_stack = []
 
-    parent_timing: Optional[StepTiming] = None
-    if len(steps_stack) > 0:
-        parent_timing = steps_stack[-1]
-    if name[0] == '_':
-        name = f'.{name[1:]}'
-    if name[0] == '.':
-        assert parent_timing is not None
+class _TimedStep:  # pylint: disable=attribute-defined-outside-init
+    # A plain class with ``__enter__`` and ``__exit__`` is cheaper to use than a generator wrapped by
+    # ``contextmanager``, and we create one of these for each timed step. The rest of the slots are
+    # only set when entering the step, to avoid paying for initializing them twice.
+    __slots__ = ('name', 'steps_stack', 'step_timing', 'yield_point')
 
-    step_timing = StepTiming(name, parent_timing)
-    steps_stack.append(step_timing)
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        steps_stack = self.steps_stack = _steps_stack()
+
+        parent_timing: Optional[StepTiming] = None
+        if steps_stack:
+            parent_timing = steps_stack[-1]
+
+        step_timing = self.step_timing = StepTiming(self.name, parent_timing)
+        steps_stack.append(step_timing)
 
-    try:
         if LOG_ALL_STEPS:
             utl.logger().debug('{[( %s', step_timing.context)
 
-        yield_point = Counters.now()
-        yield None
+        self.yield_point = Counters.now()
 
-    finally:
-        back_point = Counters.now()
+    def __exit__(self, *_exception: Any) -> None:
+        yield_point = self.yield_point
+        back_elapsed_ns = perf_counter_ns()
+        if back_elapsed_ns - yield_point.elapsed_ns < SHORT_STEP_NS:
+            back_point = Counters(back_elapsed_ns,
+                                  yield_point.cpu_ns + back_elapsed_ns - yield_point.elapsed_ns)
+        else:
+            back_point = Counters(back_elapsed_ns, process_time_ns())
         total_times = back_point - yield_point
 
         global GC_STEPS
@@ -351,22 +414,24 @@ def timed_step(name: str) -> Iterator[None]:  # pylint: disable=too-many-branche
                 gc_steps.append(gc_step)
         GC_STEPS = gc_steps
 
-        assert total_times.elapsed_ns >= 0
-        assert total_times.cpu_ns >= 0
+        step_timing = self.step_timing
         if LOG_ALL_STEPS:
             utl.logger().debug('}]) %s', step_timing.context)
 
-        steps_stack.pop()
+        self.steps_stack.pop()
 
+        parent_timing = step_timing.parent
         if parent_timing is not None:
             parent_timing.total_nested += total_times
 
         total_times -= step_timing.total_nested
 
-        _print_timing(step_timing.context, total_times, step_timing.parameters)
+        # The CPU time of short nested steps is approximated by their elapsed time, and the clocks
+        # have a limited resolution, so we may end up with (slightly) negative times here.
+        if total_times.elapsed_ns < 0 or total_times.cpu_ns < 0:
+            total_times = Counters(max(total_times.elapsed_ns, 0), max(total_times.cpu_ns, 0))
 
-        assert total_times.elapsed_ns >= 0
-        assert total_times.cpu_ns >= 0
+        _print_timing(step_timing.context, total_times, step_timing.parameters)
 
 
 def _print_timing(
@@ -378,22 +443,36 @@ def _print_timing(
     gc.disable()
 
     try:
-        global TIMING_FILE
-        if TIMING_FILE is None:
-            TIMING_FILE = \
-                open(TIMING_PATH, 'a', buffering=TIMING_BUFFERING)
-        text = [invocation_context,
-                'elapsed_ns', str(total_times.elapsed_ns),
-                'cpu_ns', str(total_times.cpu_ns)]
+        line = f'{invocation_context},' \
+            f'elapsed_ns,{total_times.elapsed_ns},cpu_ns,{total_times.cpu_ns}'
         if step_parameters:
-            text.extend(step_parameters)
-        TIMING_FILE.write(','.join(text) + '\n')
+            line += ',' + ','.join(step_parameters)
+        with TIMING_LOCK:
+            TIMING_LINES.append(line + '\n')
+            if len(TIMING_LINES) >= TIMING_BATCH:
+                _write_timing_lines()
 
     finally:
         if gc_enabled:
             gc.enable()
 
 
+def _write_timing_lines() -> None:
+    # Write the accumulated lines all at once, in a single system call, so only complete lines are
+    # ever written to the file. A system call may still write only part of the data (e.g. when the
+    # disk is full or on a signal), in which case we keep writing the rest. Only remove the lines we
+    # wrote, as a timed garbage collection in this thread may add a line while we are writing.
+    global TIMING_FD
+    with TIMING_LOCK:
+        if TIMING_FD is None:
+            TIMING_FD = os.open(TIMING_PATH, TIMING_FLAGS['a'], 0o644)
+        lines_count = len(TIMING_LINES)
+        data = memoryview(''.join(TIMING_LINES[:lines_count]).encode())
+        while data:
+            data = data[os.write(TIMING_FD, data):]
+        del TIMING_LINES[:lines_count]
+
+
 def timed_parameters(**kwargs: Any) -> None:
     '''
     Associate relevant timing parameters to the innermost
@@ -455,7 +534,7 @@ def context() -> str:
 
         The context will be the empty string unless we are actually collecting timing.
     '''
-    steps_stack = getattr(THREAD_LOCAL, 'steps_stack', None)
+    steps_stack = _steps_stack()
     if not steps_stack:
         return ''
     return steps_stack[-1].context
@@ -468,10 +547,24 @@ def current_step() -> Optional[StepTiming]:
     '''
     if not COLLECT_TIMING:
         return None
-    steps_stack = getattr(THREAD_LOCAL, 'steps_stack', None)
-    if steps_stack is None or len(steps_stack) == 0:
+    steps_stack = _steps_stack()
+    if not steps_stack:
         return None
     return steps_stack[-1]
 
 
+if not 'sphinx' in sys.argv[0]:
+    TIMING_PATH = os.environ.get('METACELL_TIMING_CSV', TIMING_PATH)
+    TIMING_MODE = os.environ.get('METACELL_TIMING_MODE', TIMING_MODE)
+    TIMING_BUFFERING = \
+        int(os.environ.get('METACELL_TIMING_BUFFERING', str(TIMING_BUFFERING)))
+    collect_timing({'true': True,
+                    'false': False}[os.environ.get('METACELLS_COLLECT_TIMING',
+                                                   str(COLLECT_TIMING)).lower()],
+                   TIMING_PATH, TIMING_MODE, buffering=TIMING_BUFFERING)
+    log_steps({'true': True,
+               'false': False}[os.environ.get('METACELLS_LOG_ALL_STEPS',
+                                              str(LOG_ALL_STEPS)).lower()])
+
+
 # This is a circular dependency so having it at the end allows the exported symbols to be seen.
@@ -625,11 +625,17 @@ def freeze(shaped: Union[ProperShaped, PandasShaped]) -> None:
     '''
     Protect the ``shaped`` data against future modification.
     '''
+    if isinstance(shaped, np.ndarray):
+        if shaped.flags.writeable:
+            shaped.setflags(write=False)
+        return
+
     compressed = maybe_compressed_matrix(shaped)
     if compressed is not None:
-        compressed.indices.setflags(write=False)
-        compressed.indptr.setflags(write=False)
-        compressed.data.setflags(write=False)
+        if compressed.data.flags.writeable:
+            compressed.indices.setflags(write=False)
+            compressed.indptr.setflags(write=False)
+            compressed.data.setflags(write=False)
         return
 
     if isinstance(shaped, (pd.DataFrame, pd.Series,
@@ -640,7 +646,8 @@ def freeze(shaped: Union[ProperShaped, PandasShaped]) -> None:
         shaped = shaped.codes
 
     if isinstance(shaped, np.ndarray):
-        shaped.setflags(write=False)
+        if shaped.flags.writeable:
+            shaped.setflags(write=False)
         return
 
     raise NotImplementedError('freeze of %s' % shaped.__class__)
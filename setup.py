@@ -18,7 +18,7 @@ INSTALL_REQUIRES = [
     'importlib-metadata',
     'numpy',
     'pandas',
-    'scipy',
+    'scipy>=1.0',
     'python-igraph',
     'threadpoolctl',
 ]
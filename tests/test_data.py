@@ -59,6 +59,33 @@ def test_find_rare_gene_modules() -> None:
         assert actual_rare_gene_modules == expected_rare_gene_modules
 
 
+def test_find_rare_gene_modules_results() -> None:
+    random = np.random.default_rng(7)
+    data = random.poisson(random.gamma(0.3, 1.0, 600)[None, :] * 0.5, (3000, 600)).astype('float32')
+    for module_index in range(2):
+        rare_cells = random.choice(3000, 20 + 5 * module_index, replace=False)
+        rare_genes = np.arange(500 + module_index * 20, 508 + module_index * 20)
+        data[:, rare_genes] = 0
+        data[np.ix_(rare_cells, rare_genes)] = random.poisson(6, (rare_cells.size, 8))
+
+    adata = AnnData(data)
+    adata.var_names = [f'G{index}' for index in range(600)]
+    mc.ut.set_name(adata, 'rare')
+
+    kwargs = dict(min_gene_maximum=3, max_gene_cell_fraction=0.05,
+                  target_pile_size=1000, min_cell_module_total=4)
+    mc.tl.find_rare_gene_modules(adata, **kwargs)
+    results = mc.tl.find_rare_gene_modules(adata, inplace=False, **kwargs)
+    assert results is not None
+    obs_metrics, var_metrics = results
+
+    assert np.any(mc.ut.get_o_numpy(adata, 'rare_cell'))
+    for name in ('cells_rare_gene_module', 'rare_cell'):
+        assert np.all(obs_metrics[name].values == mc.ut.get_o_numpy(adata, name))
+    for name in var_metrics.columns:
+        assert np.all(var_metrics[name].values == mc.ut.get_v_numpy(adata, name))
+
+
 def test_direct_pipeline() -> None:
     for path in glob('../metacells-test-data/*.h5ad'):
         adata, expected = _load(path)
@@ -7,6 +7,7 @@ from glob import glob
 from typing import Any, List
 
 import numpy as np
+from anndata import AnnData
 from scipy import sparse  # type: ignore
 from scipy import stats
 from sklearn.metrics import roc_auc_score  # type: ignore
@@ -66,6 +67,26 @@ def test_corrcoef() -> None:
         assert np.min(zeros_correlation) == 0
         assert np.max(zeros_correlation) == 0
 
+    zeros_correlation = ut.corrcoef(sparse.csr_matrix(dense.T), per='row',
+                                    reproducible=False)
+    assert zeros_correlation.shape == (100, 100)
+    assert np.min(np.diag(zeros_correlation)) == 1
+    assert np.max(np.diag(zeros_correlation)) == 1
+    np.fill_diagonal(zeros_correlation, 0)
+    assert np.min(zeros_correlation) == 0
+    assert np.max(zeros_correlation) == 0
+
+    umis = sparse.random(20, 300, density=0.2, format='csr', dtype='int32',
+                         random_state=123456, data_rvs=stats.poisson(10, loc=1).rvs)
+    umis_correlation = ut.corrcoef(umis, per='row', reproducible=False)
+    assert umis_correlation.dtype == 'float64'
+    assert np.allclose(umis_correlation, np.corrcoef(umis.toarray()), atol=1e-6)
+
+    dense_umis = ut.to_layout(umis.toarray().astype('float32'), layout='row_major')
+    original_umis = dense_umis.copy()
+    ut.corrcoef(dense_umis, per='row', reproducible=False)
+    assert np.all(dense_umis == original_umis)
+
 
 def test_logistics() -> None:
     matrix = np.array([[0, 0, 0, 0, 0, 0],
@@ -345,6 +366,45 @@ def test_parallel_map() -> None:
         os.remove(path)
 
 
+def test_parallel_map_threads() -> None:
+    rvs = stats.poisson(10, loc=10).rvs
+    csr_matrices = [sparse.random(200, 200, format='csr', dtype='int32',
+                                  random_state=123456 + index, data_rvs=rvs)
+                    for index in range(8)]
+
+    @ut.timed_call('invocation')
+    def invocation(index: int) -> bool:
+        csc_matrix = ut.to_layout(csr_matrices[index], layout='column_major')
+        return csc_matrix.has_sorted_indices \
+            and np.all(csc_matrix.toarray() == csr_matrices[index].toarray())
+
+    processors_count = ut.get_processors_count()
+    ut.set_processors_count(4)
+    try:
+        assert all(ut.parallel_map(invocation, len(csr_matrices),
+                                   max_processors=2, releases_gil=True))
+    finally:
+        ut.set_processors_count(processors_count)
+
+
+def test_parallel_map_threads_timing(tmp_path: Any) -> None:
+    processors_count = ut.get_processors_count()
+    ut.set_processors_count(4)
+    ut.collect_timing(True, str(tmp_path / 'timing.csv'))
+    try:
+        @ut.timed_call('invocation')
+        def invocation(_index: int) -> str:
+            return ut.context()
+
+        with ut.timed_step('test'):
+            contexts = ut.parallel_map(invocation, 8, releases_gil=True)
+    finally:
+        ut.collect_timing(False)
+        ut.set_processors_count(processors_count)
+
+    assert set(contexts) == {'test;parallel_map;invocation'}
+
+
 def test_sum_groups() -> None:
     expected_sums = np.array([[5, 7, 2], [10, 8, 13]])
     expected_sizes = np.array([2, 2])
@@ -490,3 +550,31 @@ def _test_per(rows_matrix: ut.Matrix) -> None:
 
     dense = ut.to_numpy_matrix(ut.fraction_by(columns_matrix, by='column'))
     assert np.allclose(dense, np.array([[0/3, 1/5, 2/7], [3/3, 4/5, 5/7]]))
+
+
+def test_set_data_forgets_layouts() -> None:
+    adata = AnnData(np.zeros((3, 4), dtype='float32'))
+
+    ut.set_vo_data(adata, 'foo', np.full((3, 4), 4, dtype='float32'))
+    assert ut.get_vo_proper(adata, 'foo', layout='column_major')[0, 0] == 4
+
+    ut.set_vo_data(adata, 'foo', np.full((3, 4), 400, dtype='float32', order='F'))
+    assert ut.get_vo_proper(adata, 'foo', layout='column_major')[0, 0] == 400
+
+
+def test_slice_by_indices() -> None:
+    adata = AnnData(np.arange(20, dtype='float32').reshape((5, 4)))
+
+    bdata = ut.slice(adata, obs=np.array([1, 2, 3]))
+    assert np.all(ut.to_numpy_matrix(bdata.X) == ut.to_numpy_matrix(adata.X)[1:4, :])
+
+    bdata = ut.slice(adata, obs=np.array([-3, -2, -1]))
+    assert np.all(ut.to_numpy_matrix(bdata.X) == ut.to_numpy_matrix(adata.X)[-3:, :])
+
+    indices = np.array([0, 1, 1, 3])
+    bdata = ut.slice(adata, obs=indices)
+    assert np.all(ut.to_numpy_matrix(bdata.X) == ut.to_numpy_matrix(adata.X)[indices, :])
+
+    indices = np.array([3, 2, 1, 0])
+    bdata = ut.slice(adata, vars=indices)
+    assert np.all(ut.to_numpy_matrix(bdata.X) == ut.to_numpy_matrix(adata.X)[:, indices])